@@ -9,6 +9,7 @@ groups = ["D", "F", "K"]
 
 for g in groups:
     seg_dir = os.path.join(path, g, wm_dir)
-    print(g, len(os.listdir(seg_dir)))
+    with os.scandir(seg_dir) as it:
+        print(g, sum(1 for _ in it))
 
 
@@ -1,12 +1,128 @@
 #!/usr/bin/env python3
 import argparse
+import mmap
 import os
 import re
 import shutil
-from glob import glob
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import numpy as np
 
+try:
+    import deflate  # libdeflate bindings (pip install deflate); optional
+except ImportError:
+    deflate = None
+
+def _gunzip_stream(src: Path, dst: Path):
+    """Gunzip src into dst with zlib, reading MiB-sized chunks (accepts the same input as gzip.open)."""
+    d = None  # decompressor of the current member; None between members
+    with open(src, "rb", buffering=0) as f_in, open(dst, "wb", buffering=1 << 20) as f_out:
+        while chunk := f_in.read(1 << 20):
+            while chunk:
+                if d is None:
+                    # Zero padding between/after members is skipped, like gzip's _read_eof
+                    chunk = chunk.lstrip(b"\0")
+                    if not chunk:
+                        break
+                    d = zlib.decompressobj(wbits=31)  # 31 = expect a gzip header/trailer
+                f_out.write(d.decompress(chunk))
+                chunk = b""
+                if d.eof:  # rest of the chunk belongs to the next member (or is padding)
+                    chunk, d = d.unused_data, None
+    if d is not None:
+        raise EOFError(f"Compressed file ended before the end-of-stream marker was reached: {src}")
+
+def _nifti1_nbytes(buf) -> int:
+    """File size implied by a NIfTI-1 header at the start of buf: vox_offset + voxels * bitpix/8 (0 if none)."""
+    if len(buf) < 348:
+        return 0
+    for end in "<>":  # sizeof_hdr is 348 in the file's byte order
+        if struct.unpack_from(end + "i", buf, 0)[0] == 348:
+            break
+    else:
+        return 0
+    dim = struct.unpack_from(end + "8h", buf, 40)
+    bitpix = struct.unpack_from(end + "h", buf, 72)[0]
+    vox_offset = struct.unpack_from(end + "f", buf, 108)[0]
+    if not 1 <= dim[0] <= 7 or bitpix <= 0 or not vox_offset >= 352:
+        return 0
+    n = 1
+    for k in dim[1:dim[0] + 1]:
+        if k <= 0:
+            return 0
+        n *= k
+    return int(vox_offset) + (n * bitpix + 7) // 8
+
+def _decompress_gz(src: Path, dst: Path):
+    """Gunzip src into dst in one shot via libdeflate; fall back to streaming zlib if unavailable."""
+    # 18 bytes = smallest gzip member; also keeps mmap away from empty files
+    if deflate is None or src.stat().st_size < 18:
+        _gunzip_stream(src, dst)
+        return
+    # gzip_decompress sizes its output from the ISIZE trailer, so it allocates once
+    with open(src, "rb") as f_in, mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        crc, isize = int.from_bytes(data[-8:-4], "little"), int.from_bytes(data[-4:], "little")
+        try:
+            out = deflate.gzip_decompress(data)
+        except deflate.DeflateError:
+            out = None
+    # libdeflate stops silently after the first member (and yields nothing on trailing
+    # padding). The last trailer alone can't prove there was only one member, so the
+    # one-shot result is only used if it is exactly the size its own NIfTI-1 header
+    # implies (and matches the trailer); anything else is streamed.
+    if (not out or len(out) != _nifti1_nbytes(out)
+            or len(out) % (1 << 32) != isize or deflate.crc32(out) != crc):
+        _gunzip_stream(src, dst)
+        return
+    raw = memoryview(out)
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)  # umask applies, as with open()
+    try:
+        while raw:  # os.write may return short for very large buffers
+            raw = raw[os.write(fd, raw):]
+    finally:
+        os.close(fd)
+
+def _copy_file(src: Path, dst: Path):
+    """Copy src to dst in the kernel via copy_file_range (a reflink on CoW filesystems); else shutil.copy2."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+                left = os.fstat(f_in.fileno()).st_size
+                while left > 0:
+                    n = os.copy_file_range(f_in.fileno(), f_out.fileno(), left)
+                    if n == 0:
+                        break
+                    left -= n
+            if left == 0:
+                shutil.copystat(src, dst)  # keep copy2 semantics (mtime etc.)
+                return
+        except OSError:
+            pass  # e.g. EXDEV/EINVAL on older kernels or unsupported filesystems
+    shutil.copy2(src, dst)
+
+def _is_up_to_date(src: Path, dst: Path) -> bool:
+    """True if dst is a complete copy from an earlier run (non-empty, not older, expected size)."""
+    try:
+        s, d = src.stat(), dst.stat()
+        if d.st_size == 0 or d.st_mtime < s.st_mtime:
+            return False
+        if src.suffix == ".gz":
+            # A NIfTI output must be exactly as long as its header says. This also catches
+            # partial earlier runs of multi-member sources, where ISIZE covers the last member only.
+            with open(dst, "rb") as f:
+                implied = _nifti1_nbytes(f.read(348))
+            if implied:
+                return d.st_size == implied
+            # Not NIfTI: gzip trailer ends with ISIZE = uncompressed size mod 2**32; catches truncated outputs
+            with open(src, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return d.st_size % (1 << 32) == int.from_bytes(f.read(4), "little")
+        return d.st_size == s.st_size
+    except OSError:
+        return False
+
 def split_sid(sid: str) -> tuple[str, str]:
     m = re.match(r"^([A-Za-z]+)(\d+)", sid)
     if not m:
@@ -21,7 +137,9 @@ def find_subject_dirs(base: Path) -> list[Path]:
     """Return sorted list of subject directories (e.g., D01, K01, …)."""
     if not base.exists():
         return []
-    subs = [p for p in base.iterdir() if p.is_dir() and SUBJECT_DIR_PAT.match(p.name)]
+    # Match the name first, then use the dirent type (no extra stat per entry)
+    with os.scandir(base) as it:
+        subs = [Path(e.path) for e in it if SUBJECT_DIR_PAT.match(e.name) and e.is_dir()]
     # Lexicographic sort is what SPM uses; D01..D10 will sort correctly if zero-padded.
     subs.sort(key=lambda p: p.name)
     return subs
@@ -36,42 +154,33 @@ def copy_seg(subject_dir: Path, out_root: Path, release: str):
     # group = sid[0]          # 'D' or 'K' (generalized)
     group, _ = split_sid(sid)
     mri_dir = subject_dir / "mri"
-    if not mri_dir.is_dir():
-        raise FileNotFoundError(f"Missing mri/ for {sid}: {mri_dir}")
-
-    # Accept .nii or .nii.gz (prefer .nii if both exist)
-    def find_one(prefix: str) -> Path:
-        candidates = sorted(glob(str(mri_dir / f"{prefix}{sid}_T1.nii"))) + \
-                     sorted(glob(str(mri_dir / f"{prefix}{sid}_T1.nii.gz")))
-        if not candidates:
-            raise FileNotFoundError(f"Missing {prefix}{sid}_T1.nii[.gz] under {mri_dir}")
-        # Prefer uncompressed NIfTI if present
-        for c in candidates:
-            if c.endswith(".nii"):
-                return Path(c)
-        return Path(candidates[0])
-
-    src_gm = find_one("mwp1")  # GM
-    src_wm = find_one("mwp2")  # WM
-
-    # Destinations
+
+    # Exact candidates (.nii preferred over .nii.gz); one stat each, no directory listing
+    nii_gm, gz_gm = mri_dir / f"mwp1{sid}_T1.nii", mri_dir / f"mwp1{sid}_T1.nii.gz"  # GM
+    nii_wm, gz_wm = mri_dir / f"mwp2{sid}_T1.nii", mri_dir / f"mwp2{sid}_T1.nii.gz"  # WM
+    src_gm = nii_gm if nii_gm.is_file() else gz_gm if gz_gm.is_file() else None
+    src_wm = nii_wm if nii_wm.is_file() else gz_wm if gz_wm.is_file() else None
+    if src_gm is None or src_wm is None:
+        if not mri_dir.is_dir():
+            raise FileNotFoundError(f"Missing mri/ for {sid}: {mri_dir}")
+        prefix = "mwp1" if src_gm is None else "mwp2"
+        raise FileNotFoundError(f"Missing {prefix}{sid}_T1.nii[.gz] under {mri_dir}")
+
+    # Destinations (created by main() before dispatch)
     rp1_dir = out_root / group / f"rp1{release}"
     rp2_dir = out_root / group / f"rp2{release}"
-    rp1_dir.mkdir(parents=True, exist_ok=True)
-    rp2_dir.mkdir(parents=True, exist_ok=True)
 
     dst_gm = rp1_dir / f"rp1_{sid}_T1.nii"
     dst_wm = rp2_dir / f"rp2_{sid}_T1.nii"
 
     # If source is .nii.gz, decompress by copying to .nii (SPM will read .nii fine)
     def copy_as_nii(src: Path, dst: Path):
+        if _is_up_to_date(src, dst):  # re-run: keep the existing output
+            return
         if src.suffix == ".gz":
-            # simple gunzip without dependencies
-            import gzip
-            with gzip.open(src, "rb") as f_in, open(dst, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            _decompress_gz(src, dst)
         else:
-            shutil.copy2(src, dst)
+            _copy_file(src, dst)
 
     copy_as_nii(src_gm, dst_gm)
     copy_as_nii(src_wm, dst_wm)
@@ -101,21 +210,26 @@ def fake_label(for_brainage: Path, seed: int = 42, mean_age: float = 85.0, std_a
         if not rp1_dir.exists():
             # no data for this group, skip
             continue
-        # Get subjects in SPM-like order by file name
-        rp1_files = sorted([p for p in rp1_dir.glob("rp1_*.nii") if p.is_file()], key=lambda p: p.name)
+        # Get subjects in SPM-like order by file name (one scandir pass, plain prefix/suffix filter)
+        with os.scandir(rp1_dir) as it:
+            rp1_files = [Path(e.path) for e in it
+                         if e.name.startswith("rp1_") and e.name.endswith(".nii") and e.is_file()]
+        rp1_files.sort(key=lambda p: p.name)
         n = len(rp1_files)
         if n == 0:
             continue
 
-        # Derive subject IDs for traceability
-        subjects = [re.sub(r"^rp1_(.+?)_T1\.nii$", r"\1", p.name) for p in rp1_files]
+        # Derive subject IDs for traceability: rp1_<ID>_T1.nii -> <ID> (the filter above guarantees "rp1_");
+        # names without a non-empty <ID> (e.g. rp1_T1.nii) are kept whole
+        subjects = np.array([p.name[4:-7] if len(p.name) > 11 and p.name.endswith("_T1.nii") else p.name
+                             for p in rp1_files])
 
         ages = rng.normal(loc=mean_age, scale=std_age, size=n)
         ages = np.clip(np.round(ages), min_age, max_age).astype(int)
         sexes = rng.integers(low=0, high=2, size=n)  # 0/1
 
         # Save
-        (labels_dir / f"subjects_{g}.txt").write_text("\n".join(subjects) + "\n", encoding="utf-8")
+        np.savetxt(labels_dir / f"subjects_{g}.txt", subjects, fmt="%s", encoding="utf-8")
         np.savetxt(labels_dir / f"age_{g}.txt", ages, fmt="%d")
         np.savetxt(labels_dir / f"male_{g}.txt", sexes, fmt="%d")
 
@@ -145,17 +259,27 @@ def main():
     if not patient_dirs and not control_dirs:
         raise SystemExit("No subject directories found. Check --root path and naming (e.g., D01, K01).")
 
-    # Copy all, remembering simple stats
+    subject_dirs = patient_dirs + control_dirs
+
+    # Create destination folders once here so the workers don't race on mkdir
+    for group in sorted({split_sid(sdir.name)[0] for sdir in subject_dirs}):
+        (out_root / group / f"rp1{args.release}").mkdir(parents=True, exist_ok=True)
+        (out_root / group / f"rp2{args.release}").mkdir(parents=True, exist_ok=True)
+
+    # Copy all in parallel (one independent task per subject), remembering simple stats
     stats = {"D": 0, "K": 0}
     errors = []
-    for sdir in patient_dirs + control_dirs:
-        try:
-            group, sid, gm, wm = copy_seg(sdir, out_root, args.release)
-            stats[group] = stats.get(group, 0) + 1
-            print(f"[copy] {sid}: -> {gm.relative_to(out_root)} ; {wm.relative_to(out_root)}")
-        except Exception as e:
-            errors.append((sdir, str(e)))
-            print(f"[ERROR] {sdir}: {e}")
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = {pool.submit(copy_seg, sdir, out_root, args.release): sdir for sdir in subject_dirs}
+        for fut in as_completed(futures):
+            sdir = futures[fut]
+            try:
+                group, sid, gm, wm = fut.result()
+                stats[group] = stats.get(group, 0) + 1
+                print(f"[copy] {sid}: -> {gm.relative_to(out_root)} ; {wm.relative_to(out_root)}")
+            except Exception as e:
+                errors.append((sdir, str(e)))
+                print(f"[ERROR] {sdir}: {e}")
 
     # Fake labels
     fake_label(out_root, seed=args.seed, mean_age=args.age_mean, std_age=args.age_std,
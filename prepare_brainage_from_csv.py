@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 import argparse
 import csv
-import gzip
+import mmap
 import os
 import re
 import shutil
-from glob import glob
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional
+
+try:
+    import deflate  # libdeflate bindings (pip install deflate); optional
+except ImportError:
+    deflate = None
 
 # Accept multi-letter group codes, e.g. D01, DK03, HC12, K7
 SID_RE = re.compile(r"^([A-Za-z]+)(\d+)$")
 
+# Accepted sex spellings -> 0/1 (built once, looked up per CSV row)
+_SEX_MAP = {
+    "0": 0, "1": 1,
+    "m": 1, "male": 1, "mann": 1, "männlich": 1,
+    "f": 0, "w": 0, "female": 0, "frau": 0, "weiblich": 0
+}
+
 def split_sid(sid: str) -> Tuple[str, str]:
     m = SID_RE.match(sid)
     if not m:
@@ -22,10 +37,120 @@ def find_subject_dirs(base: Path) -> List[Path]:
     """Return sorted <root>/<T1_CAT12(_Kontrollen)>/<SubjectID>/ directories that look like IDs."""
     if not base.exists():
         return []
-    subs = [p for p in base.iterdir() if p.is_dir() and SID_RE.match(p.name)]
+    # Match the name first, then use the dirent type (no extra stat per entry)
+    with os.scandir(base) as it:
+        subs = [Path(e.path) for e in it if SID_RE.match(e.name) and e.is_dir()]
     subs.sort(key=lambda p: p.name)  # Lexicographic order (what SPM uses)
     return subs
 
+def _gunzip_stream(src: Path, dst: Path):
+    """Gunzip src into dst with zlib, reading MiB-sized chunks (accepts the same input as gzip.open)."""
+    d = None  # decompressor of the current member; None between members
+    with open(src, "rb", buffering=0) as f_in, open(dst, "wb", buffering=1 << 20) as f_out:
+        while chunk := f_in.read(1 << 20):
+            while chunk:
+                if d is None:
+                    # Zero padding between/after members is skipped, like gzip's _read_eof
+                    chunk = chunk.lstrip(b"\0")
+                    if not chunk:
+                        break
+                    d = zlib.decompressobj(wbits=31)  # 31 = expect a gzip header/trailer
+                f_out.write(d.decompress(chunk))
+                chunk = b""
+                if d.eof:  # rest of the chunk belongs to the next member (or is padding)
+                    chunk, d = d.unused_data, None
+    if d is not None:
+        raise EOFError(f"Compressed file ended before the end-of-stream marker was reached: {src}")
+
+def _nifti1_nbytes(buf) -> int:
+    """File size implied by a NIfTI-1 header at the start of buf: vox_offset + voxels * bitpix/8 (0 if none)."""
+    if len(buf) < 348:
+        return 0
+    for end in "<>":  # sizeof_hdr is 348 in the file's byte order
+        if struct.unpack_from(end + "i", buf, 0)[0] == 348:
+            break
+    else:
+        return 0
+    dim = struct.unpack_from(end + "8h", buf, 40)
+    bitpix = struct.unpack_from(end + "h", buf, 72)[0]
+    vox_offset = struct.unpack_from(end + "f", buf, 108)[0]
+    if not 1 <= dim[0] <= 7 or bitpix <= 0 or not vox_offset >= 352:
+        return 0
+    n = 1
+    for k in dim[1:dim[0] + 1]:
+        if k <= 0:
+            return 0
+        n *= k
+    return int(vox_offset) + (n * bitpix + 7) // 8
+
+def _decompress_gz(src: Path, dst: Path):
+    """Gunzip src into dst in one shot via libdeflate; fall back to streaming zlib if unavailable."""
+    # 18 bytes = smallest gzip member; also keeps mmap away from empty files
+    if deflate is None or src.stat().st_size < 18:
+        _gunzip_stream(src, dst)
+        return
+    # gzip_decompress sizes its output from the ISIZE trailer, so it allocates once
+    with open(src, "rb") as f_in, mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        crc, isize = int.from_bytes(data[-8:-4], "little"), int.from_bytes(data[-4:], "little")
+        try:
+            out = deflate.gzip_decompress(data)
+        except deflate.DeflateError:
+            out = None
+    # libdeflate stops silently after the first member (and yields nothing on trailing
+    # padding). The last trailer alone can't prove there was only one member, so the
+    # one-shot result is only used if it is exactly the size its own NIfTI-1 header
+    # implies (and matches the trailer); anything else is streamed.
+    if (not out or len(out) != _nifti1_nbytes(out)
+            or len(out) % (1 << 32) != isize or deflate.crc32(out) != crc):
+        _gunzip_stream(src, dst)
+        return
+    raw = memoryview(out)
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)  # umask applies, as with open()
+    try:
+        while raw:  # os.write may return short for very large buffers
+            raw = raw[os.write(fd, raw):]
+    finally:
+        os.close(fd)
+
+def _copy_file(src: Path, dst: Path):
+    """Copy src to dst in the kernel via copy_file_range (a reflink on CoW filesystems); else shutil.copy2."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+                left = os.fstat(f_in.fileno()).st_size
+                while left > 0:
+                    n = os.copy_file_range(f_in.fileno(), f_out.fileno(), left)
+                    if n == 0:
+                        break
+                    left -= n
+            if left == 0:
+                shutil.copystat(src, dst)  # keep copy2 semantics (mtime etc.)
+                return
+        except OSError:
+            pass  # e.g. EXDEV/EINVAL on older kernels or unsupported filesystems
+    shutil.copy2(src, dst)
+
+def _is_up_to_date(src: Path, dst: Path) -> bool:
+    """True if dst is a complete copy from an earlier run (non-empty, not older, expected size)."""
+    try:
+        s, d = src.stat(), dst.stat()
+        if d.st_size == 0 or d.st_mtime < s.st_mtime:
+            return False
+        if src.suffix == ".gz":
+            # A NIfTI output must be exactly as long as its header says. This also catches
+            # partial earlier runs of multi-member sources, where ISIZE covers the last member only.
+            with open(dst, "rb") as f:
+                implied = _nifti1_nbytes(f.read(348))
+            if implied:
+                return d.st_size == implied
+            # Not NIfTI: gzip trailer ends with ISIZE = uncompressed size mod 2**32; catches truncated outputs
+            with open(src, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return d.st_size % (1 << 32) == int.from_bytes(f.read(4), "little")
+        return d.st_size == s.st_size
+    except OSError:
+        return False
+
 def copy_seg_for_sid(subject_dir: Path, out_root: Path, release: str) -> Tuple[str, str, Path, Path]:
     """
     Copy mwp1/mwp2 from <subject>/mri into:
@@ -35,37 +160,32 @@ def copy_seg_for_sid(subject_dir: Path, out_root: Path, release: str) -> Tuple[s
     sid = subject_dir.name
     group, _ = split_sid(sid)
     mri_dir = subject_dir / "mri"
-    if not mri_dir.is_dir():
-        raise FileNotFoundError(f"Missing mri/ for {sid}: {mri_dir}")
-
-    def find_one(prefix: str) -> Path:
-        # Prefer uncompressed .nii if both exist
-        cands = sorted(glob(str(mri_dir / f"{prefix}{sid}_T1.nii"))) + \
-                sorted(glob(str(mri_dir / f"{prefix}{sid}_T1.nii.gz")))
-        if not cands:
-            raise FileNotFoundError(f"Missing {prefix}{sid}_T1.nii[.gz] in {mri_dir}")
-        for c in cands:
-            if c.endswith(".nii"):
-                return Path(c)
-        return Path(cands[0])
-
-    src_gm = find_one("mwp1")  # GM
-    src_wm = find_one("mwp2")  # WM
 
+    # Exact candidates (.nii preferred over .nii.gz); one stat each, no directory listing
+    nii_gm, gz_gm = mri_dir / f"mwp1{sid}_T1.nii", mri_dir / f"mwp1{sid}_T1.nii.gz"  # GM
+    nii_wm, gz_wm = mri_dir / f"mwp2{sid}_T1.nii", mri_dir / f"mwp2{sid}_T1.nii.gz"  # WM
+    src_gm = nii_gm if nii_gm.is_file() else gz_gm if gz_gm.is_file() else None
+    src_wm = nii_wm if nii_wm.is_file() else gz_wm if gz_wm.is_file() else None
+    if src_gm is None or src_wm is None:
+        if not mri_dir.is_dir():
+            raise FileNotFoundError(f"Missing mri/ for {sid}: {mri_dir}")
+        prefix = "mwp1" if src_gm is None else "mwp2"
+        raise FileNotFoundError(f"Missing {prefix}{sid}_T1.nii[.gz] in {mri_dir}")
+
+    # Destination folders are created by main() before dispatch
     rp1_dir = out_root / group / f"rp1{release}"
     rp2_dir = out_root / group / f"rp2{release}"
-    rp1_dir.mkdir(parents=True, exist_ok=True)
-    rp2_dir.mkdir(parents=True, exist_ok=True)
 
     dst_gm = rp1_dir / f"rp1_{sid}_T1.nii"
     dst_wm = rp2_dir / f"rp2_{sid}_T1.nii"
 
     def copy_as_nii(src: Path, dst: Path):
+        if _is_up_to_date(src, dst):  # re-run: keep the existing output
+            return
         if src.suffix == ".gz":
-            with gzip.open(src, "rb") as f_in, open(dst, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            _decompress_gz(src, dst)
         else:
-            shutil.copy2(src, dst)
+            _copy_file(src, dst)
 
     copy_as_nii(src_gm, dst_gm)
     copy_as_nii(src_wm, dst_wm)
@@ -74,13 +194,18 @@ def copy_seg_for_sid(subject_dir: Path, out_root: Path, release: str) -> Tuple[s
 # ---------- CSV handling ----------
 
 def _sniff_delimiter(path: Path) -> str:
-    sample = path.read_bytes()[:65536].decode("utf-8", errors="ignore")
-    try:
-        dialect = csv.Sniffer().sniff(sample, delimiters=";,|\t,")
-        return dialect.delimiter
-    except Exception:
-        # Fallback to comma
-        return ","
+    # Pick the most frequent candidate in the first line (ties -> earlier in the tuple)
+    with open(path, newline="", encoding="utf-8", errors="ignore") as f:
+        line = f.readline()
+    counts = {d: line.count(d) for d in (",", ";", "|", "\t")}
+    best = max(counts, key=counts.get)
+    # Fallback to comma
+    return best if counts[best] else ","
+
+def _iter_rows(path: Path, delim: str) -> Iterator[List[str]]:
+    """Yield CSV rows one at a time (file stays open until exhausted)."""
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from csv.reader(f, delimiter=delim)
 
 def parse_csv(
     csv_path: Path,
@@ -98,14 +223,12 @@ def parse_csv(
     Only rows with valid SID, age, sex are returned.
     """
     delim = _sniff_delimiter(csv_path)
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.reader(f, delimiter=delim)
-        rows = list(reader)
+    rows = _iter_rows(csv_path, delim)  # streamed, single pass
 
-    if not rows:
+    header = next(rows, None)
+    if header is None:
         raise ValueError("CSV appears empty.")
 
-    header = rows[0]
     has_header = any(not SID_RE.match(c or "") for c in header)  # crude but effective
 
     def idx_from_name(name: str) -> int:
@@ -127,7 +250,7 @@ def parse_csv(
             raise ValueError("Provide either column *names* or 1-based *indices* for id, age, and sex.")
         id_i, age_i, sex_i = id_col - 1, age_col - 1, sex_col - 1
 
-    data_rows = rows[1:] if has_header else rows
+    data_rows = rows if has_header else chain([header], rows)
 
     mapping: Dict[str, Tuple[int, int]] = {}
     bad_rows = 0
@@ -149,16 +272,10 @@ def parse_csv(
             bad_rows += 1
             continue
 
-        # Sex: map generously
+        # Sex: map generously, else accept a numeric 0/1
         sex_raw = (r[sex_i] or "").strip().lower()
-        sex_map = {
-            "0": 0, "1": 1,
-            "m": 1, "male": 1, "mann": 1, "männlich": 1,
-            "f": 0, "w": 0, "female": 0, "frau": 0, "weiblich": 0
-        }
-        if sex_raw in sex_map:
-            sex = sex_map[sex_raw]
-        else:
+        sex = _SEX_MAP.get(sex_raw)
+        if sex is None:
             try:
                 v = int(float(sex_raw))
                 if v not in (0,1):
@@ -179,6 +296,11 @@ def parse_csv(
 
 # ---------- Labels writing ----------
 
+def _write_lines(path: Path, items) -> None:
+    """Write one item per line, streamed through a large buffer (no joined string)."""
+    with open(path, "w", encoding="utf-8", buffering=1 << 20) as f:
+        f.writelines(f"{x}\n" for x in items)
+
 def write_group_labels(for_brainage: Path, relabel: Dict[str, Dict[str, Tuple[int, int]]]):
     """
     relabel: {group -> {sid -> (age, sex)}}
@@ -191,11 +313,9 @@ def write_group_labels(for_brainage: Path, relabel: Dict[str, Dict[str, Tuple[in
         if not sid_map:
             continue
         sids_sorted = sorted(sid_map.keys())  # rp1_*.nii sorting matches this
-        ages = [str(sid_map[s][0]) for s in sids_sorted]
-        males = [str(sid_map[s][1]) for s in sids_sorted]
-        (labels_dir / f"subjects_{group}.txt").write_text("\n".join(sids_sorted) + "\n", encoding="utf-8")
-        (labels_dir / f"age_{group}.txt").write_text("\n".join(ages) + "\n", encoding="utf-8")
-        (labels_dir / f"male_{group}.txt").write_text("\n".join(males) + "\n", encoding="utf-8")
+        _write_lines(labels_dir / f"subjects_{group}.txt", sids_sorted)
+        _write_lines(labels_dir / f"age_{group}.txt", (sid_map[s][0] for s in sids_sorted))
+        _write_lines(labels_dir / f"male_{group}.txt", (sid_map[s][1] for s in sids_sorted))
         print(f"[labels] Group {group}: n={len(sids_sorted)} -> age_{group}.txt, male_{group}.txt")
 
 # ---------- Main ----------
@@ -230,13 +350,16 @@ def main():
         id_col, age_col, sex_col = args.id_col, args.age_col, args.sex_col
 
     sid_to_labels = parse_csv(csv_path, id_col, age_col, sex_col, id_name, age_name, sex_name)
-    wanted_sids = set(sid_to_labels.keys())
+    wanted_sids = sid_to_labels.keys()  # keeps CSV order
     print(f"[info] Subjects in CSV: {len(wanted_sids)}")
 
     # Source directories
     src_patients   = root / "T1_CAT12"
     src_controls   = root / "T1_CAT12_Kontrollen"
-    subject_dirs   = find_subject_dirs(src_patients) + find_subject_dirs(src_controls)
+    # Scan both trees concurrently (directory listing is latency-bound on network shares)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        patient_dirs, control_dirs = pool.map(find_subject_dirs, (src_patients, src_controls))
+    subject_dirs   = patient_dirs + control_dirs
     sid_to_dir     = {p.name: p for p in subject_dirs}
 
     missing_on_disk = sorted([sid for sid in wanted_sids if sid not in sid_to_dir])
@@ -248,18 +371,27 @@ def main():
     errors: List[Tuple[str, str]] = []
 
     # Copy only the subjects present in the CSV and on disk
-    for sid in sorted(wanted_sids):
-        if sid not in sid_to_dir:
-            continue
-        sdir = sid_to_dir[sid]
-        try:
-            group, _, gm, wm = copy_seg_for_sid(sdir, out_root, args.release)
-            stats[group] = stats.get(group, 0) + 1
-            relabel.setdefault(group, {})[sid] = sid_to_labels[sid]
-            print(f"[copy] {sid}: -> {gm.relative_to(out_root)} ; {wm.relative_to(out_root)}")
-        except Exception as e:
-            errors.append((sid, str(e)))
-            print(f"[ERROR] {sid}: {e}")
+    # CSV order (usually scan order); labels are sorted when written
+    todo = [sid for sid in wanted_sids if sid in sid_to_dir]
+
+    # Create destination folders once here so the workers don't race on mkdir
+    for group in sorted({split_sid(sid)[0] for sid in todo}):
+        (out_root / group / f"rp1{args.release}").mkdir(parents=True, exist_ok=True)
+        (out_root / group / f"rp2{args.release}").mkdir(parents=True, exist_ok=True)
+
+    # One independent copy task per subject; stats/relabel are only touched here in the parent
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = {pool.submit(copy_seg_for_sid, sid_to_dir[sid], out_root, args.release): sid for sid in todo}
+        for fut in as_completed(futures):
+            sid = futures[fut]
+            try:
+                group, _, gm, wm = fut.result()
+                stats[group] = stats.get(group, 0) + 1
+                relabel.setdefault(group, {})[sid] = sid_to_labels[sid]
+                print(f"[copy] {sid}: -> {gm.relative_to(out_root)} ; {wm.relative_to(out_root)}")
+            except Exception as e:
+                errors.append((sid, str(e)))
+                print(f"[ERROR] {sid}: {e}")
 
     # Write per-group labels matching the file order
     write_group_labels(out_root, relabel)
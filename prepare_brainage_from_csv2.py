@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 import argparse
 import csv
-import gzip
+import mmap
+import os
 import re
 import shutil
-from glob import glob
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
+
+try:
+    import deflate  # libdeflate bindings (pip install deflate); optional
+except ImportError:
+    deflate = None
 
 # SID_RE = re.compile(r"^([A-Za-z]+)(\d+)$")  # e.g., D01, FD02, K9
 SID_RE = re.compile(r"^([A-Za-z]+)(\d+[A-Za-z]?)$") # e.g., D01, FD02, K9, K11a, etc
+_sid_match = SID_RE.match  # bound once; used on every dir entry / CSV row
+
+# Sex codes accepted in the sheet (1=m, 2=f)
+_MALE = frozenset({"1", "m", "male", "mann", "männlich"})
+_FEMALE = frozenset({"0", "2", "f", "female", "frau", "weiblich"})
 
 # ---------- ID parsing ----------
 def split_sid(sid: str) -> Tuple[str, str]:
-    # m = SID_RE.match(sid)
-    m = re.match(r"^([A-Za-z]+)(\d+[A-Za-z]?)$", sid)
+    m = _sid_match(sid)
     if not m:
         raise ValueError(f"Subject ID '{sid}' must look like <Letters><Digits> (e.g., D01, FD03)")
     return m.group(1), m.group(2)  # (group, number)
@@ -23,44 +36,150 @@ def split_sid(sid: str) -> Tuple[str, str]:
 def find_subject_dirs(base: Path) -> List[Path]:
     if not base.exists():
         return []
-    subs = [p for p in base.iterdir() if p.is_dir() and SID_RE.match(p.name)]
+    # Match the name first, then use the dirent type (no extra stat per entry)
+    with os.scandir(base) as it:
+        subs = [Path(e.path) for e in it if _sid_match(e.name) and e.is_dir()]
     subs.sort(key=lambda p: p.name)  # SPM-like lexicographic order
     return subs
 
+def _gunzip_stream(src: Path, dst: Path):
+    """Gunzip src into dst with zlib, reading MiB-sized chunks (accepts the same input as gzip.open)."""
+    d = None  # decompressor of the current member; None between members
+    with open(src, "rb", buffering=0) as fin, open(dst, "wb", buffering=1 << 20) as fout:
+        while chunk := fin.read(1 << 20):
+            while chunk:
+                if d is None:
+                    # Zero padding between/after members is skipped, like gzip's _read_eof
+                    chunk = chunk.lstrip(b"\0")
+                    if not chunk:
+                        break
+                    d = zlib.decompressobj(wbits=31)  # 31 = expect a gzip header/trailer
+                fout.write(d.decompress(chunk))
+                chunk = b""
+                if d.eof:  # rest of the chunk belongs to the next member (or is padding)
+                    chunk, d = d.unused_data, None
+    if d is not None:
+        raise EOFError(f"Compressed file ended before the end-of-stream marker was reached: {src}")
+
+def _nifti1_nbytes(buf) -> int:
+    """File size implied by a NIfTI-1 header at the start of buf: vox_offset + voxels * bitpix/8 (0 if none)."""
+    if len(buf) < 348:
+        return 0
+    for end in "<>":  # sizeof_hdr is 348 in the file's byte order
+        if struct.unpack_from(end + "i", buf, 0)[0] == 348:
+            break
+    else:
+        return 0
+    dim = struct.unpack_from(end + "8h", buf, 40)
+    bitpix = struct.unpack_from(end + "h", buf, 72)[0]
+    vox_offset = struct.unpack_from(end + "f", buf, 108)[0]
+    if not 1 <= dim[0] <= 7 or bitpix <= 0 or not vox_offset >= 352:
+        return 0
+    n = 1
+    for k in dim[1:dim[0] + 1]:
+        if k <= 0:
+            return 0
+        n *= k
+    return int(vox_offset) + (n * bitpix + 7) // 8
+
+def _decompress_gz(src: Path, dst: Path):
+    """Gunzip src into dst in one shot via libdeflate; fall back to streaming zlib if unavailable."""
+    # 18 bytes = smallest gzip member; also keeps mmap away from empty files
+    if deflate is None or src.stat().st_size < 18:
+        _gunzip_stream(src, dst)
+        return
+    # gzip_decompress sizes its output from the ISIZE trailer, so it allocates once
+    with open(src, "rb") as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        crc, isize = int.from_bytes(data[-8:-4], "little"), int.from_bytes(data[-4:], "little")
+        try:
+            out = deflate.gzip_decompress(data)
+        except deflate.DeflateError:
+            out = None
+    # libdeflate stops silently after the first member (and yields nothing on trailing
+    # padding). The last trailer alone can't prove there was only one member, so the
+    # one-shot result is only used if it is exactly the size its own NIfTI-1 header
+    # implies (and matches the trailer); anything else is streamed.
+    if (not out or len(out) != _nifti1_nbytes(out)
+            or len(out) % (1 << 32) != isize or deflate.crc32(out) != crc):
+        _gunzip_stream(src, dst)
+        return
+    raw = memoryview(out)
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)  # umask applies, as with open()
+    try:
+        while raw:  # os.write may return short for very large buffers
+            raw = raw[os.write(fd, raw):]
+    finally:
+        os.close(fd)
+
+def _copy_file(src: Path, dst: Path):
+    """Copy src to dst in the kernel via copy_file_range (a reflink on CoW filesystems); else shutil.copy2."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fin, open(dst, "wb") as fout:
+                left = os.fstat(fin.fileno()).st_size
+                while left > 0:
+                    n = os.copy_file_range(fin.fileno(), fout.fileno(), left)
+                    if n == 0:
+                        break
+                    left -= n
+            if left == 0:
+                shutil.copystat(src, dst)  # keep copy2 semantics (mtime etc.)
+                return
+        except OSError:
+            pass  # e.g. EXDEV/EINVAL on older kernels or unsupported filesystems
+    shutil.copy2(src, dst)
+
+def _is_up_to_date(src: Path, dst: Path) -> bool:
+    """True if dst is a complete copy from an earlier run (non-empty, not older, expected size)."""
+    try:
+        s, d = src.stat(), dst.stat()
+        if d.st_size == 0 or d.st_mtime < s.st_mtime:
+            return False
+        if src.suffix == ".gz":
+            # A NIfTI output must be exactly as long as its header says. This also catches
+            # partial earlier runs of multi-member sources, where ISIZE covers the last member only.
+            with open(dst, "rb") as f:
+                implied = _nifti1_nbytes(f.read(348))
+            if implied:
+                return d.st_size == implied
+            # Not NIfTI: gzip trailer ends with ISIZE = uncompressed size mod 2**32; catches truncated outputs
+            with open(src, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                return d.st_size % (1 << 32) == int.from_bytes(f.read(4), "little")
+        return d.st_size == s.st_size
+    except OSError:
+        return False
+
 def copy_seg_for_sid(subject_dir: Path, out_root: Path, release: str) -> Tuple[str, str, Path, Path]:
     sid = subject_dir.name
     group, _ = split_sid(sid)
     mri_dir = subject_dir / "mri"
-    if not mri_dir.is_dir():
-        raise FileNotFoundError(f"Missing mri/ for {sid}: {mri_dir}")
-
-    def pick(prefix: str) -> Path:
-        cands = sorted(glob(str(mri_dir / f"{prefix}{sid}_T1.nii"))) + \
-                sorted(glob(str(mri_dir / f"{prefix}{sid}_T1.nii.gz")))
-        if not cands:
-            raise FileNotFoundError(f"Missing {prefix}{sid}_T1.nii[.gz] in {mri_dir}")
-        for c in cands:
-            if c.endswith(".nii"):
-                return Path(c)
-        return Path(cands[0])
-
-    src_gm = pick("mwp1")  # GM
-    src_wm = pick("mwp2")  # WM
 
+    # Exact candidates (.nii preferred over .nii.gz); one stat each, no directory listing
+    nii_gm, gz_gm = mri_dir / f"mwp1{sid}_T1.nii", mri_dir / f"mwp1{sid}_T1.nii.gz"  # GM
+    nii_wm, gz_wm = mri_dir / f"mwp2{sid}_T1.nii", mri_dir / f"mwp2{sid}_T1.nii.gz"  # WM
+    src_gm = nii_gm if nii_gm.is_file() else gz_gm if gz_gm.is_file() else None
+    src_wm = nii_wm if nii_wm.is_file() else gz_wm if gz_wm.is_file() else None
+    if src_gm is None or src_wm is None:
+        if not mri_dir.is_dir():
+            raise FileNotFoundError(f"Missing mri/ for {sid}: {mri_dir}")
+        prefix = "mwp1" if src_gm is None else "mwp2"
+        raise FileNotFoundError(f"Missing {prefix}{sid}_T1.nii[.gz] in {mri_dir}")
+
+    # created by main() before dispatch
     rp1_dir = out_root / group / f"rp1{release}"
     rp2_dir = out_root / group / f"rp2{release}"
-    rp1_dir.mkdir(parents=True, exist_ok=True)
-    rp2_dir.mkdir(parents=True, exist_ok=True)
 
     dst_gm = rp1_dir / f"rp1_{sid}_T1.nii"
     dst_wm = rp2_dir / f"rp2_{sid}_T1.nii"
 
     def copy_as_nii(src: Path, dst: Path):
+        if _is_up_to_date(src, dst):  # re-run: keep the existing output
+            return
         if src.suffix == ".gz":
-            with gzip.open(src, "rb") as fin, open(dst, "wb") as fout:
-                shutil.copyfileobj(fin, fout)
+            _decompress_gz(src, dst)
         else:
-            shutil.copy2(src, dst)
+            _copy_file(src, dst)
 
     copy_as_nii(src_gm, dst_gm)
     copy_as_nii(src_wm, dst_wm)
@@ -68,11 +187,17 @@ def copy_seg_for_sid(subject_dir: Path, out_root: Path, release: str) -> Tuple[s
 
 # ---------- CSV parsing tailored to German headers ----------
 def _sniff_delim(p: Path) -> str:
-    txt = p.read_bytes()[:65536].decode("utf-8", errors="ignore")
-    try:
-        return csv.Sniffer().sniff(txt, delimiters=";,|\t,").delimiter
-    except Exception:
-        return ";"
+    # Most frequent candidate in the header line; ';' wins ties and is the fallback
+    with open(p, newline="", encoding="utf-8", errors="ignore") as f:
+        line = f.readline()
+    counts = {d: line.count(d) for d in (";", ",", "|", "\t")}
+    best = max(counts, key=counts.get)
+    return best if counts[best] else ";"
+
+def _iter_rows(path: Path, delim: str) -> Iterator[List[str]]:
+    """Yield CSV rows one at a time (file stays open until exhausted)."""
+    with open(path, newline="", encoding="utf-8") as f:
+        yield from csv.reader(f, delimiter=delim)
 
 def _find_col(header: List[str], candidates: List[str]) -> int:
     low = [h.strip().lower() for h in header]
@@ -89,19 +214,18 @@ def parse_csv_german(csv_path: Path) -> Dict[str, Tuple[int, int]]:
     Returns mapping SID -> (age_int, male_flag) with male=1, female=0.
     """
     delim = _sniff_delim(csv_path)
-    with open(csv_path, newline="", encoding="utf-8") as f:
-        rows = list(csv.reader(f, delimiter=delim))
+    rows = _iter_rows(csv_path, delim)  # streamed, single pass
 
-    if not rows:
+    header = next(rows, None)
+    if header is None:
         raise ValueError("CSV is empty.")
 
-    header = rows[0]
     has_header = True
     code_i = _find_col(header, ["code"])
     age_i  = _find_col(header, ["alter", "age"])
     sex_i  = _find_col(header, ["geschlecht", "sex"])
 
-    data = rows[1:] if has_header else rows
+    data = rows if has_header else chain([header], rows)
     out: Dict[str, Tuple[int, int]] = {}
     skipped = 0
 
@@ -109,7 +233,7 @@ def parse_csv_german(csv_path: Path) -> Dict[str, Tuple[int, int]]:
         # if max(code_i, age_i, sex_i) >= len(r):
         #     skipped += 1; continue
         sid = (r[code_i] or "").strip()
-        if not SID_RE.match(sid):  # skip group headers or blanks
+        if not _sid_match(sid):  # skip group headers or blanks
             continue
 
         # Age
@@ -123,9 +247,9 @@ def parse_csv_german(csv_path: Path) -> Dict[str, Tuple[int, int]]:
         # Sex mapping: sheet uses 1=m, 2=f
         sx = (r[sex_i] or "").strip().lower()
         male = None
-        if sx in {"1", "m", "male", "mann", "männlich"}:
+        if sx in _MALE:
             male = 1
-        elif sx in {"0", "2", "f", "female", "frau", "weiblich"}:
+        elif sx in _FEMALE:
             male = 0
         else:
             # try numeric
@@ -147,6 +271,11 @@ def parse_csv_german(csv_path: Path) -> Dict[str, Tuple[int, int]]:
     return out
 
 # ---------- Label writing ----------
+def _write_lines(path: Path, items) -> None:
+    """Write one item per line, streamed through a large buffer (no joined string)."""
+    with open(path, "w", encoding="utf-8", buffering=1 << 20) as f:
+        f.writelines(f"{x}\n" for x in items)
+
 def write_group_labels(for_brainage: Path, relabel: Dict[str, Dict[str, Tuple[int, int]]], subdir="labels"):
     labels_dir = for_brainage / subdir
     labels_dir.mkdir(parents=True, exist_ok=True)
@@ -154,11 +283,9 @@ def write_group_labels(for_brainage: Path, relabel: Dict[str, Dict[str, Tuple[in
         if not sid_map:
             continue
         sids = sorted(sid_map.keys())                 # matches rp1_*.nii sort
-        ages = [str(sid_map[s][0]) for s in sids]
-        males = [str(sid_map[s][1]) for s in sids]    # 1=male, 0=female
-        (labels_dir / f"subjects_{group}.txt").write_text("\n".join(sids) + "\n", encoding="utf-8")
-        (labels_dir / f"age_{group}.txt").write_text("\n".join(ages) + "\n", encoding="utf-8")
-        (labels_dir / f"male_{group}.txt").write_text("\n".join(males) + "\n", encoding="utf-8")
+        _write_lines(labels_dir / f"subjects_{group}.txt", sids)
+        _write_lines(labels_dir / f"age_{group}.txt", (sid_map[s][0] for s in sids))
+        _write_lines(labels_dir / f"male_{group}.txt", (sid_map[s][1] for s in sids))  # 1=male, 0=female
         print(f"[labels] {group}: n={len(sids)}")
 
 # ---------- Main ----------
@@ -176,13 +303,15 @@ def main():
 
     # Parse CSV
     sid2lab = parse_csv_german(Path(args.csv).resolve())
-    wanted = set(sid2lab.keys())
+    wanted = sid2lab.keys()  # keeps CSV order
     print(f"[info] CSV subjects: {len(wanted)}")
 
     # Find all available subject dirs
     src_pat = root / "T1_CAT12"
     src_ctl = root / "T1_CAT12_Kontrollen"
-    sid2dir = {p.name: p for p in find_subject_dirs(src_pat) + find_subject_dirs(src_ctl)}
+    with ThreadPoolExecutor(max_workers=2) as pool:  # scan both trees concurrently
+        pat_dirs, ctl_dirs = pool.map(find_subject_dirs, (src_pat, src_ctl))
+    sid2dir = {p.name: p for p in pat_dirs + ctl_dirs}
 
     missing = sorted([s for s in wanted if s not in sid2dir])
     if missing:
@@ -192,16 +321,24 @@ def main():
     stats: Dict[str, int] = {}
     relabel: Dict[str, Dict[str, Tuple[int, int]]] = {}
 
-    for sid in sorted(wanted):
-        if sid not in sid2dir:
-            continue
-        try:
-            group, _, gm, wm = copy_seg_for_sid(sid2dir[sid], out_root, args.release)
-            stats[group] = stats.get(group, 0) + 1
-            relabel.setdefault(group, {})[sid] = sid2lab[sid]
-            print(f"[copy] {sid}: -> {gm.relative_to(out_root)} ; {wm.relative_to(out_root)}")
-        except Exception as e:
-            print(f"[ERROR] {sid}: {e}")
+    todo = [sid for sid in wanted if sid in sid2dir]  # CSV order; labels get sorted on write
+
+    # mkdir once in the parent so the workers don't race on it
+    for group in sorted({split_sid(sid)[0] for sid in todo}):
+        (out_root / group / f"rp1{args.release}").mkdir(parents=True, exist_ok=True)
+        (out_root / group / f"rp2{args.release}").mkdir(parents=True, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = {pool.submit(copy_seg_for_sid, sid2dir[sid], out_root, args.release): sid for sid in todo}
+        for fut in as_completed(futures):
+            sid = futures[fut]
+            try:
+                group, _, gm, wm = fut.result()
+                stats[group] = stats.get(group, 0) + 1
+                relabel.setdefault(group, {})[sid] = sid2lab[sid]
+                print(f"[copy] {sid}: -> {gm.relative_to(out_root)} ; {wm.relative_to(out_root)}")
+            except Exception as e:
+                print(f"[ERROR] {sid}: {e}")
 
     write_group_labels(out_root, relabel, subdir="labels")
 